@@ -5,148 +5,238 @@ Extracts EXIF GPS data from photos and generates KML files with photo links
 """
 
 import os
-import uuid
+import html
+import secrets
 import base64
+from io import BytesIO
 from datetime import datetime
-from flask import Flask, request, render_template_string, jsonify, send_file, url_for
+from flask import Flask, Request, request, render_template_string, jsonify, send_file, url_for
 from werkzeug.utils import secure_filename
+import numpy as np
 from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+from PIL.ExifTags import IFD
+
+class UploadRequest(Request):
+    """Request that buffers uploaded files in memory instead of a temp file"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # MAX_CONTENT_LENGTH already caps the body, so spilling to a temporary
+        # file would only add a disk write and read-back before the photo is saved
+        return BytesIO()
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-change-in-production')
 app.config['UPLOAD_FOLDER'] = 'uploads'
-app.config['KML_FOLDER'] = 'kml_files'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Let a fronting server (Apache mod_xsendfile, lighttpd) stream stored photos
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
 
 # Create directories if they don't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['KML_FOLDER'], exist_ok=True)
 
-ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'tiff', 'heic'}
+ALLOWED_EXTENSIONS = frozenset(('jpg', 'jpeg', 'png', 'tiff', 'heic'))
+
+# Leading bytes of each accepted format, checked before Pillow sees the file
+JPEG_SIGNATURE = b'\xff\xd8\xff'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*')
+HEIC_BRANDS = frozenset((b'heic', b'heix', b'mif1', b'msf1'))
+
+# EXIF tag ids, so lookups skip the TAGS/GPSTAGS name tables
+TAG_DATETIME = 0x0132
+TAG_DATETIME_ORIGINAL = 0x9003
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+GPS_ALTITUDE_REF = 5
+GPS_ALTITUDE = 6
+GPS_FIX_TAGS = (GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE)
+
+# Raw GPS ref values, compared as stored so no tag names are resolved.
+# GPSAltitudeRef is an EXIF BYTE, which Pillow hands back as bytes.
+NEGATIVE_REFS = ('S', 'W')
+BELOW_SEA_LEVEL = frozenset((1, b'\x01'))
+
+# Degrees, minutes and seconds weights for DMS to decimal conversion
+DMS_WEIGHTS = np.array([1.0, 1 / 60.0, 1 / 3600.0])
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-def get_exif_data(image_path):
-    """Extract EXIF data from image including GPS coordinates"""
-    try:
-        image = Image.open(image_path)
-        exif_data = image._getexif()
-
-        if not exif_data:
-            return None
+    _, dot, extension = filename.rpartition('.')
+    return bool(dot) and extension.lower() in ALLOWED_EXTENSIONS
+
+def is_image_header(header):
+    """Check the first 12 bytes of a file against the supported image signatures"""
+    return (
+        header.startswith(JPEG_SIGNATURE)
+        or header.startswith(PNG_SIGNATURE)
+        or header[:4] in TIFF_SIGNATURES
+        or (header[4:8] == b'ftyp' and header[8:12] in HEIC_BRANDS)
+    )
 
-        extracted_data = {}
+def has_image_header(file):
+    """Sniff an uploaded file's signature without consuming its stream"""
+    header = file.stream.read(12)
+    file.stream.seek(0)
+    return is_image_header(header)
 
-        for tag_id, value in exif_data.items():
-            tag = TAGS.get(tag_id, tag_id)
+def save_upload(file):
+    """Write an uploaded photo to the upload folder and return its stored filename"""
+    file_extension = file.filename.rpartition('.')[2].lower()
+    unique_filename = f"{secrets.token_hex(16)}.{file_extension}"
 
-            if tag == "GPSInfo":
-                gps_data = {}
-                for gps_tag_id, gps_value in value.items():
-                    gps_tag = GPSTAGS.get(gps_tag_id, gps_tag_id)
-                    gps_data[gps_tag] = gps_value
-                extracted_data["GPSInfo"] = gps_data
-            else:
-                extracted_data[tag] = value
+    # EXIF parsing has already read from the stream, so rewind before copying
+    file.stream.seek(0)
+    file.save(os.path.join(app.config['UPLOAD_FOLDER'], unique_filename))
+    return unique_filename
 
-        return extracted_data
+def get_exif_data(image_file):
+    """Extract EXIF data from an uploaded image file including GPS coordinates"""
+    try:
+        # Image.open only parses the header, and the context manager releases
+        # the image as soon as the metadata has been read
+        with Image.open(image_file) as image:
+            exif_data = image.getexif()
+
+            if not exif_data:
+                return None
+
+            # Only the GPS block and the capture time are used downstream
+            return {
+                "GPSInfo": exif_data.get_ifd(IFD.GPSInfo),
+                "DateTime": exif_data.get(TAG_DATETIME),
+                "DateTimeOriginal": exif_data.get_ifd(IFD.Exif).get(TAG_DATETIME_ORIGINAL)
+            }
     except Exception as e:
         print(f"Error extracting EXIF: {e}")
         return None
 
-def convert_to_degrees(value):
-    """Convert GPS coordinates from DMS to decimal degrees"""
+def convert_to_degrees(value, ref=None):
+    """Convert GPS coordinates from DMS to signed decimal degrees"""
     d, m, s = value
-    return float(d) + float(m)/60 + float(s)/3600
+    degrees = float(d) + float(m) / 60.0 + float(s) / 3600.0
+    return -degrees if ref in NEGATIVE_REFS else degrees
 
-def get_gps_coordinates(exif_data):
-    """Extract GPS coordinates from EXIF data"""
-    if not exif_data or "GPSInfo" not in exif_data:
+def get_gps_altitude(gps_info):
+    """Return signed altitude in metres from a GPS block, or None if absent"""
+    if GPS_ALTITUDE not in gps_info:
         return None
 
-    gps_info = exif_data["GPSInfo"]
+    altitude = float(gps_info[GPS_ALTITUDE])
+    return -altitude if gps_info.get(GPS_ALTITUDE_REF) in BELOW_SEA_LEVEL else altitude
 
-    try:
-        # Get latitude
-        if "GPSLatitude" in gps_info and "GPSLatitudeRef" in gps_info:
-            lat = convert_to_degrees(gps_info["GPSLatitude"])
-            if gps_info["GPSLatitudeRef"] == "S":
-                lat = -lat
-
-        # Get longitude
-        if "GPSLongitude" in gps_info and "GPSLongitudeRef" in gps_info:
-            lon = convert_to_degrees(gps_info["GPSLongitude"])
-            if gps_info["GPSLongitudeRef"] == "W":
-                lon = -lon
-
-        # Get altitude if available
-        altitude = None
-        if "GPSAltitude" in gps_info:
-            altitude = float(gps_info["GPSAltitude"])
-            if gps_info.get("GPSAltitudeRef") == 1:  # Below sea level
-                altitude = -altitude
-
-        return {
-            "latitude": lat,
-            "longitude": lon,
-            "altitude": altitude
-        }
-    except (KeyError, ValueError, TypeError) as e:
-        print(f"Error parsing GPS coordinates: {e}")
+def read_gps_fix(gps_info):
+    """Pull a validated raw (dms, hemispheres, altitude) fix out of a GPS block, or None"""
+    # A block missing either coordinate or its ref is not a usable fix
+    if not gps_info or not all(tag in gps_info for tag in GPS_FIX_TAGS):
         return None
 
-def create_kml(photo_filename, coordinates, photo_url, timestamp=None):
-    """Create KML file with photo location and link to original photo"""
+    # Refs must be the ASCII strings of a well-formed block, not numbers or bytes
+    hemispheres = (gps_info[GPS_LATITUDE_REF], gps_info[GPS_LONGITUDE_REF])
+    if not all(isinstance(ref, str) for ref in hemispheres):
+        return None
 
-    # Create KML structure
-    kml = ET.Element("kml", xmlns="http://www.opengis.net/kml/2.2")
-    document = ET.SubElement(kml, "Document")
+    try:
+        latitude, longitude = gps_info[GPS_LATITUDE], gps_info[GPS_LONGITUDE]
 
-    # Document info
-    name = ET.SubElement(document, "name")
-    name.text = f"Photo Location: {photo_filename}"
+        # Each coordinate must be its own degrees, minutes, seconds triple
+        if len(latitude) != 3 or len(longitude) != 3:
+            return None
 
-    description = ET.SubElement(document, "description")
-    description.text = f"GPS location extracted from {photo_filename}"
+        # Latitude then longitude degrees, minutes, seconds as plain floats
+        dms = [float(v) for v in (*latitude, *longitude)]
+        altitude = get_gps_altitude(gps_info)
+    except (ValueError, TypeError) as e:
+        print(f"Error parsing GPS coordinates: {e}")
+        return None
 
-    # Create placemark
-    placemark = ET.SubElement(document, "Placemark")
+    return dms, hemispheres, altitude
 
-    # Placemark name
-    pm_name = ET.SubElement(placemark, "name")
-    pm_name.text = photo_filename
+def get_gps_coordinates(exif_data):
+    """Extract GPS coordinates from EXIF data"""
+    fix = read_gps_fix(exif_data.get("GPSInfo") if exif_data else None)
+    if not fix:
+        return None
 
-    # Placemark description with photo
-    pm_description = ET.SubElement(placemark, "description")
-    pm_description.text = f"""
-    <![CDATA[
-    <h3>{photo_filename}</h3>
-    <p>Captured: {timestamp or 'Unknown'}</p>
-    <p>Coordinates: {coordinates['latitude']:.6f}, {coordinates['longitude']:.6f}</p>
-    {f"<p>Altitude: {coordinates['altitude']:.2f}m</p>" if coordinates['altitude'] else ""}
-    <img src="{photo_url}" width="300" alt="Photo"/><br/>
-    <a href="{photo_url}" target="_blank">View Full Size</a>
-    ]]>
-    """
+    dms, (lat_ref, lon_ref), altitude = fix
+    return {
+        "latitude": convert_to_degrees(dms[:3], lat_ref),
+        "longitude": convert_to_degrees(dms[3:], lon_ref),
+        "altitude": altitude
+    }
+
+def read_photo_gps(image_file):
+    """Return raw (dms, hemispheres, altitude, timestamp) for a photo, or None without GPS data"""
+    exif_data = get_exif_data(image_file)
+    fix = read_gps_fix(exif_data["GPSInfo"] if exif_data else None)
+    if not fix:
+        return None
 
-    # Point coordinates
-    point = ET.SubElement(placemark, "Point")
-    coords = ET.SubElement(point, "coordinates")
+    return (*fix, exif_data['DateTime'] or exif_data['DateTimeOriginal'])
+
+def batch_convert_to_degrees(dms_rows, hemispheres):
+    """Convert N rows of lat/lon DMS values to an (N, 2) array of signed decimal degrees"""
+    dms = np.asarray(dms_rows, dtype=np.float64).reshape(-1, 2, 3)
+    degrees = dms @ DMS_WEIGHTS
+    return np.where(np.isin(np.asarray(hemispheres), NEGATIVE_REFS), -degrees, degrees)
+
+# KML is emitted without indentation; Google Earth does not need it, and the
+# adjacent literals below only keep the templates readable in source
+KML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<kml xmlns="http://www.opengis.net/kml/2.2">'
+    '<Document>'
+    '<name>{name}</name>'
+    '<description>{description}</description>'
+)
+
+PLACEMARK_TEMPLATE = (
+    '<Placemark>'
+    '<name>{name}</name>'
+    '<description><![CDATA['
+    '<h3>{name}</h3>'
+    '<p>Captured: {timestamp}</p>'
+    '<p>Coordinates: {latitude:.6f}, {longitude:.6f}</p>'
+    '{altitude}'
+    '<img src="{photo_url}" width="300" alt="Photo"/><br/>'
+    '<a href="{photo_url}" target="_blank">View Full Size</a>'
+    ']]></description>'
+    '<Point><coordinates>{coordinates}</coordinates></Point>'
+    '</Placemark>'
+)
+
+KML_FOOTER = '</Document></kml>\n'
+
+def create_placemark(photo_filename, coordinates, photo_url, timestamp=None):
+    """Render a single KML placemark with photo location and link to original photo"""
 
     if coordinates['altitude']:
-        coords.text = f"{coordinates['longitude']},{coordinates['latitude']},{coordinates['altitude']}"
+        coords = f"{coordinates['longitude']},{coordinates['latitude']},{coordinates['altitude']}"
+        altitude = f"<p>Altitude: {coordinates['altitude']:.2f}m</p>"
     else:
-        coords.text = f"{coordinates['longitude']},{coordinates['latitude']}"
-
-    # Pretty print XML
-    rough_string = ET.tostring(kml, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
+        coords = f"{coordinates['longitude']},{coordinates['latitude']}"
+        altitude = ""
+
+    # User-controlled values are escaped; the rest of the document is static
+    return PLACEMARK_TEMPLATE.format(
+        name=html.escape(photo_filename),
+        timestamp=html.escape(str(timestamp or 'Unknown')),
+        latitude=coordinates['latitude'],
+        longitude=coordinates['longitude'],
+        altitude=altitude,
+        photo_url=html.escape(photo_url),
+        coordinates=coords
+    )
 
-    return reparsed.toprettyxml(indent="  ")
+def render_kml(name, description, placemarks):
+    """Render a complete KML document with one placemark per located photo"""
+    # placemarks yields (photo_filename, coordinates, photo_url, timestamp) tuples
+    return ''.join((
+        KML_HEADER.format(name=html.escape(name), description=html.escape(description)),
+        *(create_placemark(*placemark) for placemark in placemarks),
+        KML_FOOTER
+    ))
 
 @app.route('/')
 def index():
@@ -162,16 +252,12 @@ def upload_file():
         return jsonify({'error': 'No file selected'}), 400
 
     if file and allowed_file(file.filename):
-        # Generate unique filename
-        file_extension = file.filename.rsplit('.', 1)[1].lower()
-        unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        # Reject files that only claim to be images before Pillow opens them
+        if not has_image_header(file):
+            return jsonify({'error': 'File contents are not a JPG, PNG, TIFF, or HEIC image'}), 400
 
-        # Save file
-        file.save(filepath)
-
-        # Extract EXIF data
-        exif_data = get_exif_data(filepath)
+        # Extract EXIF data straight from the upload stream
+        exif_data = get_exif_data(file.stream)
         if not exif_data:
             return jsonify({'error': 'No EXIF data found in image'}), 400
 
@@ -180,31 +266,26 @@ def upload_file():
         if not coordinates:
             return jsonify({'error': 'No GPS coordinates found in image EXIF data'}), 400
 
+        # Only persist photos that actually carry a location
+        unique_filename = save_upload(file)
+
         # Get timestamp if available
-        timestamp = exif_data.get('DateTime', exif_data.get('DateTimeOriginal'))
+        timestamp = exif_data['DateTime'] or exif_data['DateTimeOriginal']
 
         # Create photo URL
         photo_url = url_for('uploaded_file', filename=unique_filename, _external=True)
 
-        # Generate KML
-        kml_content = create_kml(
-            file.filename,
-            coordinates,
-            photo_url,
-            timestamp
+        # Generate KML; it is returned inline rather than stored
+        kml_content = render_kml(
+            f"Photo Location: {file.filename}",
+            f"GPS location extracted from {file.filename}",
+            [(file.filename, coordinates, photo_url, timestamp)]
         )
 
-        # Save KML file
-        kml_filename = f"{uuid.uuid4().hex}.kml"
-        kml_filepath = os.path.join(app.config['KML_FOLDER'], kml_filename)
-
-        with open(kml_filepath, 'w', encoding='utf-8') as f:
-            f.write(kml_content)
-
         return jsonify({
             'success': True,
             'photo_url': photo_url,
-            'kml_url': url_for('download_kml', filename=kml_filename, _external=True),
+            'kml': kml_content,
             'coordinates': coordinates,
             'timestamp': timestamp,
             'original_filename': file.filename
@@ -212,19 +293,83 @@ def upload_file():
 
     return jsonify({'error': 'Invalid file type. Please upload JPG, PNG, TIFF, or HEIC files.'}), 400
 
+@app.route('/batch_upload', methods=['POST'])
+def batch_upload():
+    files = [file for file in request.files.getlist('photos') if file.filename]
+    if not files:
+        return jsonify({'error': 'No photo files provided'}), 400
+
+    located = []
+    errors = []
+
+    for file in files:
+        if not allowed_file(file.filename):
+            errors.append({'original_filename': file.filename, 'error': 'Invalid file type'})
+            continue
+
+        if not has_image_header(file):
+            errors.append({'original_filename': file.filename, 'error': 'File contents are not a supported image'})
+            continue
+
+        # Parse straight from the in-memory upload, as /upload does
+        reading = read_photo_gps(file.stream)
+        if not reading:
+            errors.append({
+                'original_filename': file.filename,
+                'error': 'No GPS coordinates found in image EXIF data'
+            })
+            continue
+
+        located.append((file, reading))
+
+    if not located:
+        return jsonify({'error': 'No GPS coordinates found in any photo', 'errors': errors}), 400
+
+    # Convert the whole batch from DMS in one vectorized pass
+    degrees = batch_convert_to_degrees(
+        [reading[0] for _, reading in located],
+        [reading[1] for _, reading in located]
+    )
+
+    placemarks = []
+    for (file, reading), (latitude, longitude) in zip(located, degrees.tolist()):
+        _, _, altitude, timestamp = reading
+        unique_filename = save_upload(file)
+
+        coordinates = {
+            "latitude": latitude,
+            "longitude": longitude,
+            "altitude": altitude
+        }
+        photo_url = url_for('uploaded_file', filename=unique_filename, _external=True)
+        placemarks.append((file.filename, coordinates, photo_url, timestamp))
+
+    # One KML document with a placemark per located photo
+    kml_content = render_kml(
+        "Photo Locations",
+        f"GPS locations extracted from {len(placemarks)} photos",
+        placemarks
+    )
+
+    return jsonify({
+        'success': True,
+        'kml': kml_content,
+        'photos': [
+            {
+                'original_filename': original_filename,
+                'photo_url': photo_url,
+                'coordinates': coordinates,
+                'timestamp': timestamp
+            }
+            for original_filename, coordinates, photo_url, timestamp in placemarks
+        ],
+        'errors': errors
+    })
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
 
-@app.route('/kml/<filename>')
-def download_kml(filename):
-    return send_file(
-        os.path.join(app.config['KML_FOLDER'], filename),
-        as_attachment=True,
-        download_name=filename,
-        mimetype='application/vnd.google-earth.kml+xml'
-    )
-
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
 <html lang="en">
@@ -482,6 +627,7 @@ HTML_TEMPLATE = '''
         const loading = document.getElementById('loading');
         const result = document.getElementById('result');
         const error = document.getElementById('error');
+        let kmlObjectUrl = null;
 
         // Handle drag and drop
         uploadArea.addEventListener('dragover', (e) => {
@@ -560,7 +706,14 @@ HTML_TEMPLATE = '''
                     `;
 
                     document.getElementById('photoLink').href = data.photo_url;
-                    document.getElementById('kmlLink').href = data.kml_url;
+                    // The KML comes back inline, so serve the download from a Blob
+                    if (kmlObjectUrl) {
+                        URL.revokeObjectURL(kmlObjectUrl);
+                    }
+                    kmlObjectUrl = URL.createObjectURL(
+                        new Blob([data.kml], { type: 'application/vnd.google-earth.kml+xml' })
+                    );
+                    document.getElementById('kmlLink').href = kmlObjectUrl;
                     document.getElementById('kmlLink').download = `${data.original_filename.split('.')[0]}.kml`;
 
                     document.getElementById('previewImage').src = data.photo_url;
@@ -581,4 +734,4 @@ HTML_TEMPLATE = '''
 '''
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,17 @@
+"""Gunicorn settings for the Photo to KML app"""
+
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# Size from the CPUs this process may actually run on, not the host total
+if hasattr(os, 'sched_getaffinity'):
+    cpus = len(os.sched_getaffinity(0))
+else:
+    cpus = os.cpu_count() or 1
+
+# Threaded workers keep serving while other uploads are still streaming in
+workers = int(os.environ.get('WEB_CONCURRENCY', cpus * 2 + 1))
+worker_class = 'gthread'
+threads = 4
+timeout = 120